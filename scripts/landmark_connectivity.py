@@ -1,60 +1,168 @@
 import argparse
-import math
 import os
-import random
+import re
 import sys
+import tempfile
+import zipfile
 from typing import Dict, List, Tuple
-from itertools import product
-import matplotlib.pyplot as plt
+import numba
+import numpy as np
 
 from py_factor_graph.utils.logging_utils import logger
-from py_factor_graph.factor_graph import FactorGraphData
-from py_factor_graph.io.pyfg_file import read_from_pyfg_file
-from py_factor_graph.utils.name_utils import (
-    get_robot_idx_from_char, 
-    get_robot_char_from_number
+from py_factor_graph.utils.name_utils import get_robot_char_from_number
+
+# PyFG line types needed to count robot-landmark connectivity; trailing spaces keep
+# prefixes such as VERTEX_XY from matching VERTEX_XYZ or VERTEX_XY:PRIOR
+RANGE_MEASURE_TYPE = "EDGE_RANGE "
+POSE_TYPES = ("VERTEX_SE2 ", "VERTEX_SE3:QUAT ")
+LANDMARK_TYPES = ("VERTEX_XY ", "VERTEX_XYZ ")
+
+# Matches whole landmark symbols (e.g. L1 but not the L1 prefix of L10)
+LANDMARK_SYMBOL_PATTERN = re.compile(rb"\bL\d+\b")
+
+# Buffer size for every file opened by this script, so writes reach the OS in few large syscalls
+IO_BUFFER_SIZE = 1 << 20
+
+# Number of bytes read per chunk when reindexing a PyFG file
+REINDEX_CHUNK_SIZE = 1 << 20
+
+# Bump whenever the contents of the .assoc.npz association sidecars change meaning
+ASSOCIATION_CACHE_VERSION = 3
+
+# Below this many measurements the thread startup cost outweighs a parallel histogram
+PARALLEL_HIST_THRESHOLD = 1_000_000
+
+@numba.njit(
+    "int64[:, ::1](int32[::1], int8[::1], int64, int64)",
+    cache=True,
+    error_model="numpy",
+)
+def _hist(
+    landmark_idx: np.ndarray, robot_idx: np.ndarray, num_landmarks: int, num_robots: int
+) -> np.ndarray:
+    """Count how many times each robot measures each landmark.
+
+    Args:
+        landmark_idx (np.ndarray): landmark index of each measurement
+        robot_idx (np.ndarray): robot index of each measurement
+        num_landmarks (int): number of landmarks
+        num_robots (int): number of robots
+
+    Returns:
+        np.ndarray: (num_landmarks, num_robots) count matrix
+    """
+    out = np.zeros((num_landmarks, num_robots), np.int64)
+    for k in range(landmark_idx.size):
+        out[landmark_idx[k], robot_idx[k]] += 1
+    return out
+
+@numba.njit(
+    "int64[:, ::1](int32[::1], int8[::1], int64, int64, int64)",
+    parallel=True,
+    cache=True,
+    error_model="numpy",
 )
+def _hist_par(
+    landmark_idx: np.ndarray,
+    robot_idx: np.ndarray,
+    num_landmarks: int,
+    num_robots: int,
+    num_threads: int,
+) -> np.ndarray:
+    """Count how many times each robot measures each landmark across threads.
 
-def append_frequency_to_csv(frequency: Dict[str, List[int]], num_robots: int, csv_fp: str) -> None:
+    Each thread accumulates into its own bins, which are summed at the end.
+
+    Args:
+        landmark_idx (np.ndarray): landmark index of each measurement
+        robot_idx (np.ndarray): robot index of each measurement
+        num_landmarks (int): number of landmarks
+        num_robots (int): number of robots
+        num_threads (int): number of threads, at least numba.get_num_threads()
+
+    Returns:
+        np.ndarray: (num_landmarks, num_robots) count matrix
+    """
+    local = np.zeros((num_threads, num_landmarks, num_robots), np.int64)
+    for k in numba.prange(landmark_idx.size):
+        local[numba.get_thread_id(), landmark_idx[k], robot_idx[k]] += 1
+    return local.sum(axis=0)
+
+def count_measurements(
+    landmark_idx: np.ndarray, robot_idx: np.ndarray, num_landmarks: int, num_robots: int
+) -> np.ndarray:
+    """Count how many times each robot measures each landmark, in parallel for large datasets
+    with few enough landmarks and robots that per-thread bins stay small.
+
+    Args:
+        landmark_idx (np.ndarray): landmark index of each measurement
+        robot_idx (np.ndarray): robot index of each measurement
+        num_landmarks (int): number of landmarks
+        num_robots (int): number of robots
+
+    Returns:
+        np.ndarray: (num_landmarks, num_robots) count matrix
+
+    Raises:
+        ValueError: if a measurement refers to a landmark or robot outside the count matrix
+    """
+    # The compiled kernels do not bounds check, so reject undeclared landmarks and robots up front
+    if landmark_idx.size:
+        if landmark_idx.min() < 0 or landmark_idx.max() >= num_landmarks:
+            raise ValueError(
+                f"Range measurement refers to a landmark outside the {num_landmarks} declared landmarks"
+            )
+        if robot_idx.min() < 0 or robot_idx.max() >= num_robots:
+            raise ValueError(
+                f"Range measurement refers to a robot outside the {num_robots} declared robots"
+            )
+
+    # The parallel kernel allocates one (num_landmarks, num_robots) bin per thread, so only use it when
+    # that scratch space is no larger than the measurements themselves
+    num_threads = numba.get_num_threads()
+    if (
+        landmark_idx.size < PARALLEL_HIST_THRESHOLD
+        or num_threads * num_landmarks * num_robots > landmark_idx.size
+    ):
+        return _hist(landmark_idx, robot_idx, num_landmarks, num_robots)
+    return _hist_par(landmark_idx, robot_idx, num_landmarks, num_robots, num_threads)
+
+def append_frequency_to_csv(counts: np.ndarray, csv_fp: str) -> None:
     """Append the frequency of each robot seeing each landmark to a CSV file.
 
     Args:
-        frequency (Dict[str, List[int]]): frequency of each robot seeing each landmark
+        counts (np.ndarray): (num_landmarks, num_robots) frequency of each robot seeing each landmark
         csv_fp (str): filepath to save the CSV file
 
     Returns:
         None
     """
-    with open(csv_fp, "w") as f:
-        f.write("landmark_symbol")
-        for i in range(num_robots):
-            f.write(f",{get_robot_char_from_number(i)}_count")
-        f.write("\n")
-
-        for landmark, freq in frequency.items():
-            f.write(landmark)
-            for count in freq:
-                f.write(f",{count}")
-            f.write("\n")
+    num_robots = counts.shape[1]
+    header = ",".join(
+        ["landmark_symbol"] + [f"{get_robot_char_from_number(i)}_count" for i in range(num_robots)]
+    ) + "\n"
+
+    # Build the row format once and apply it with %-formatting, which is much cheaper than f-strings per cell
+    row_fmt = ",".join(["L%d"] + ["%d"] * num_robots) + "\n"
+    body = "".join(row_fmt % (i, *row) for i, row in enumerate(counts.tolist()))
+
+    with open(csv_fp, "w", buffering=IO_BUFFER_SIZE) as f:
+        f.write(header)
+        f.write(body)
 
 def reindex_landmarks(pyfg_filepath: str, num_robots: int, landmark_owner: Dict[str, str], output_dir: str) -> None:
     """Reindex the landmarks in the PyFG dataset based on the ownership of the landmarks.
 
     Args:
         pyfg_filepath (str): Filepath to the PyFG dataset
+        num_robots (int): number of robots
         landmark_owner (Dict[str, str]): ownership of each landmark
+        output_dir (str): existing directory to save the reindexed PyFG dataset
     
     Returns:
         None
     """
 
-    assert pyfg_filepath.endswith(".pyfg"), logger.critical(
-        "Dataset must be in PyFG format."
-    )
-
-    if (not os.path.isdir(output_dir)):
-        os.makedirs(output_dir)
-
     # Reindexed PyFG dataset
     base = os.path.basename(pyfg_filepath)
     reindexed_pyfg_filepath = os.path.join(output_dir, f"{os.path.splitext(base)[0]}_with_ownership.pyfg")
@@ -66,111 +174,208 @@ def reindex_landmarks(pyfg_filepath: str, num_robots: int, landmark_owner: Dict[
     reindexed_landmark_owner: Dict[str, str] = {}
     landmark_owner_count: List[int] = [0] * num_robots
     for i, (landmark, owner) in enumerate(landmark_owner.items()):
-        owner_idx = get_robot_idx_from_char(owner)
+        owner_idx = ord(owner) - ord("A")
         print("owner idx: " + str(owner_idx))
         reindexed_landmark_owner[landmark] = f"L{owner}{landmark_owner_count[owner_idx]}"
         landmark_owner_count[owner_idx] += 1
     print(reindexed_landmark_owner)
     
-    # Replace all instances of the landmark with the new reindexed landmark
-    with open(pyfg_filepath, "r") as f, open(reindexed_pyfg_filepath, "w") as reindexed_f:
-        for line in f:
-            for landmark, reindexed_landmark in reindexed_landmark_owner.items():
-                line = line.replace(landmark, reindexed_landmark)
-            reindexed_f.write(line)
+    # The dataset is rewritten as raw ASCII bytes, so look up reindexed symbols as bytes too
+    reindexed_symbols: Dict[bytes, bytes] = {
+        landmark.encode("ascii"): reindexed.encode("ascii")
+        for landmark, reindexed in reindexed_landmark_owner.items()
+    }
+
+    def reindex_symbol(match: re.Match) -> bytes:
+        landmark = match.group(0)
+        return reindexed_symbols.get(landmark, landmark)
+
+    # Replace all instances of the landmark with the new reindexed landmark, streaming the file in chunks.
+    # Each chunk is cut at its last newline so no landmark symbol straddles two chunks, and the output
+    # is accumulated and only written once at least IO_BUFFER_SIZE bytes are pending.
+    with open(pyfg_filepath, "rb", buffering=IO_BUFFER_SIZE) as f, open(
+        reindexed_pyfg_filepath, "wb", buffering=IO_BUFFER_SIZE
+    ) as reindexed_f:
+        buf = bytearray()
+        tail = b""
+        while True:
+            chunk = f.read(REINDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            head, newline, tail = (tail + chunk).rpartition(b"\n")
+            buf += LANDMARK_SYMBOL_PATTERN.sub(reindex_symbol, head + newline)
+            if len(buf) >= IO_BUFFER_SIZE:
+                reindexed_f.write(buf)
+                buf.clear()
+        buf += LANDMARK_SYMBOL_PATTERN.sub(reindex_symbol, tail)
+        reindexed_f.write(buf)
+
+
+def load_associations(pyfg_filepath: str) -> Tuple[np.ndarray, np.ndarray, int, int]:
+    """Load the robot-landmark range measurement associations of a PyFG dataset.
+
+    The associations are cached in a .assoc.npz sidecar next to the dataset, which is reused
+    as long as it was written by the current parser version for a dataset of exactly the same
+    size and modification time, so repeated runs skip parsing the PyFG file.
 
+    Args:
+        pyfg_filepath (str): filepath to the PyFG dataset
 
-def landmark_counter(pyfg_filepath: str, output_dir: str) -> Dict[str, List[int]]:
-    """Analyze the connectivity between landmarks and agents in a PyFG dataset.
+    Returns:
+        Tuple[np.ndarray, np.ndarray, int, int]: landmark index and robot index of each
+            robot-landmark measurement, number of landmarks, and number of robots
+    """
+    # Identify the dataset by its exact size and modification time; tools such as cp -p, rsync -t
+    # and tar keep old timestamps when replacing a file, so "sidecar is newer" is not enough
+    pyfg_stat = os.stat(pyfg_filepath)
+    source = np.array([pyfg_stat.st_size, pyfg_stat.st_mtime_ns], dtype=np.int64)
+
+    sidecar_filepath = pyfg_filepath + ".assoc.npz"
+    if os.path.exists(sidecar_filepath):
+        try:
+            with np.load(sidecar_filepath) as sidecar:
+                # Sidecars written by a different parser version may count robots or landmarks differently
+                if (
+                    "version" in sidecar.files
+                    and int(sidecar["version"]) == ASSOCIATION_CACHE_VERSION
+                    and np.array_equal(sidecar["source"], source)
+                ):
+                    num_landmarks, num_robots = sidecar["shape"].tolist()
+                    return sidecar["l"], sidecar["r"], num_landmarks, num_robots
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            logger.warning(f"Ignoring unreadable association cache {sidecar_filepath}: {e}")
+
+    # Only the range measurement associations are needed, so scan the raw lines instead of building
+    # the full factor graph and hand the measurement rows to NumPy's C tokenizer in one call
+    with open(pyfg_filepath, "r", buffering=IO_BUFFER_SIZE, encoding="ascii") as f:
+        lines = f.read().splitlines()
+
+    range_lines = [line for line in lines if line.startswith(RANGE_MEASURE_TYPE)]
+    pose_lines = [line for line in lines if line.startswith(POSE_TYPES)]
+    num_landmarks = sum(1 for line in lines if line.startswith(LANDMARK_TYPES))
+
+    # Robots are numbered by the first character of their pose symbols, e.g. A0, B0. Like
+    # read_from_pyfg_file, count up to the highest robot so gaps (A and C only) keep C in range
+    if pose_lines:
+        pose_symbols = np.loadtxt(pose_lines, dtype=str, usecols=2, ndmin=1)
+        num_robots = int(pose_symbols.astype("U1").view(np.uint32).max()) - ord("A") + 1
+    else:
+        num_robots = 0
+
+    if range_lines:
+        associations = np.loadtxt(range_lines, dtype=str, usecols=(2, 3), ndmin=2)
+    else:
+        associations = np.empty((0, 2), dtype=str)
+
+    # Skip over inter-robot range measurements
+    associations = associations[np.char.startswith(associations[:, 1], "L")]
+    landmark_idx = np.char.lstrip(associations[:, 1], "L").astype(np.int32)
+    robot_idx = (associations[:, 0].astype("U1").view(np.uint32) - ord("A")).astype(np.int8)
+
+    # Write to a temporary file next to the sidecar and move it into place, so an interrupted
+    # write never leaves a truncated sidecar behind
+    tmp_filepath = None
+    try:
+        fd, tmp_filepath = tempfile.mkstemp(
+            suffix=".npz", prefix=os.path.basename(sidecar_filepath) + ".", dir=os.path.dirname(sidecar_filepath)
+        )
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                l=landmark_idx,
+                r=robot_idx,
+                shape=np.array([num_landmarks, num_robots], dtype=np.int64),
+                version=np.array(ASSOCIATION_CACHE_VERSION),
+                source=source,
+            )
+        # mkstemp creates the file owner-only; give the sidecar the usual permissions for new files
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filepath, 0o666 & ~umask)
+        os.replace(tmp_filepath, sidecar_filepath)
+    except OSError as e:
+        logger.warning(f"Could not cache associations to {sidecar_filepath}: {e}")
+        if tmp_filepath is not None and os.path.exists(tmp_filepath):
+            try:
+                os.remove(tmp_filepath)
+            except OSError:
+                pass
+
+    return landmark_idx, robot_idx, num_landmarks, num_robots
+
+def landmark_counter_to_array(pyfg_filepath: str) -> np.ndarray:
+    """Count the connectivity between landmarks and agents in a PyFG dataset.
 
     Args:
         pyfg_filepath (str): filepath to the PyFG dataset
-        output_dir (str): directory to save the results
     
     Returns:
-        None
+        np.ndarray: (num_landmarks, num_robots) frequency of each robot seeing each landmark
     """
 
-    assert pyfg_filepath.endswith(".pyfg"), logger.critical(
-        "Dataset must be in PyFG format."
-    )
-
-    if (not os.path.isdir(output_dir)):
-        os.makedirs(output_dir)
-    
-    pyfg_data: FactorGraphData = read_from_pyfg_file(pyfg_filepath)
-    robot_landmark_frequency: Dict[str, List[int]] = {}
-
     logger.info(f"Counting frequency of connectivity between robots and landmarks in {pyfg_filepath}")
 
-    # For each landmark, initialize array where each element corresponds to the frequency of a robot seeing a landmark
-    for i in range(pyfg_data.num_landmarks):
-        landmark = f"L{i}"
-        robot_landmark_frequency[landmark] = [0] * pyfg_data.num_robots
+    landmark_idx, robot_idx, num_landmarks, num_robots = load_associations(pyfg_filepath)
+    return count_measurements(landmark_idx, robot_idx, num_landmarks, num_robots)
 
-    range_measurements = pyfg_data.range_measurements
-    for measure in range_measurements:
-        # Skip over inter-robot range measurements
-        if measure.association[1][0] != "L":
-            continue
+def landmark_counter_to_csv(pyfg_filepath: str, output_dir: str) -> np.ndarray:
+    """Analyze the connectivity between landmarks and agents in a PyFG dataset and save it to a CSV file.
 
-        landmark = measure.association[1]
-        robot = measure.association[0]
+    Args:
+        pyfg_filepath (str): filepath to the PyFG dataset
+        output_dir (str): existing directory to save the results
+    
+    Returns:
+        np.ndarray: (num_landmarks, num_robots) frequency of each robot seeing each landmark
+    """
 
-        robot_idx = get_robot_idx_from_char(robot[0])
-        robot_landmark_frequency[landmark][robot_idx] += 1
+    counts = landmark_counter_to_array(pyfg_filepath)
 
     # Save the frequency of each robot seeing each landmark to a CSV file
     base = os.path.basename(pyfg_filepath)
     frequency_csv_file = os.path.join(output_dir, f"{os.path.splitext(base)[0]}_landmark_connectivity.csv")
 
-    append_frequency_to_csv(robot_landmark_frequency, pyfg_data.num_robots, frequency_csv_file)
+    append_frequency_to_csv(counts, frequency_csv_file)
 
-    return robot_landmark_frequency
+    return counts
 
 def assign_ownership_to_landmarks(
         pyfg_filepath: str, 
-        robot_landmark_frequency: str, 
+        robot_landmark_frequency: np.ndarray, 
         output_dir: str) -> None:
     """Assign ownership to landmarks to the robot that has the highest frequency of seeing the landmark.
 
     Args:
         pyfg_filepath (str): filepath to the PyFG dataset
-        robot_landmark_frequency (Dict[str, List[int]]): frequency of each robot seeing each landmark
-        output_dir (str): directory to save the results with updated ownership
+        robot_landmark_frequency (np.ndarray): (num_landmarks, num_robots) frequency of each robot seeing each landmark
+        output_dir (str): existing directory to save the results with updated ownership
     
     Returns:
         None
     """
 
-    assert pyfg_filepath.endswith(".pyfg"), logger.critical(
-        "Dataset must be in PyFG format."
-    )
+    logger.info(f"Assigning ownership of landmarks in {pyfg_filepath}")
 
-    if (not os.path.isdir(output_dir)):
-        os.makedirs(output_dir)
+    # The frequency rows already span every robot, so the dataset does not need to be parsed again
+    num_robots = robot_landmark_frequency.shape[1]
 
-    logger.info(f"Assigning ownership of landmarks in {pyfg_filepath}")
-    pyfg_data: FactorGraphData = read_from_pyfg_file(pyfg_filepath)
-    
-    # Assign ownership to landmarks
+    # Without any robots no landmark can be seen, so every landmark stays unowned
     landmark_owner: Dict[str, str] = {}
-    for landmark, freq in robot_landmark_frequency.items():
-        # If none of the robots see the landmark, continue
-        if sum(freq) == 0:
-            continue
+    if num_robots > 0:
+        # Assign ownership to the robot with the highest frequency (first robot on partial ties)
+        owners = robot_landmark_frequency.argmax(axis=1)
 
-        # If tie, randomly assign ownership
-        if all(x == freq[0] for x in freq):
-            robot_idx = math.floor(random.random() * len(freq))
-            landmark_owner[landmark] = get_robot_char_from_number(robot_idx)
-            continue
+        # If every robot sees the landmark equally often, randomly assign ownership
+        tie_mask = (robot_landmark_frequency == robot_landmark_frequency[:, :1]).all(axis=1)
+        owners[tie_mask] = np.random.randint(0, num_robots, int(tie_mask.sum()))
 
-        max_freq = max(freq)
-        robot_idx = freq.index(max_freq)
-        landmark_owner[landmark] = get_robot_char_from_number(robot_idx)
+        # If none of the robots see the landmark, leave it unowned
+        seen = np.flatnonzero(robot_landmark_frequency.sum(axis=1) > 0)
+        landmark_owner = {
+            f"L{i}": chr(ord("A") + owner) for i, owner in zip(seen.tolist(), owners[seen].tolist())
+        }
 
-    reindex_landmarks(pyfg_filepath, pyfg_data.num_robots, landmark_owner, output_dir)
+    reindex_landmarks(pyfg_filepath, num_robots, landmark_owner, output_dir)
 
 def landmark_connectivity(args) -> None:
     """Recursively scan directory for PyFG files and analyze connectivity between landmarks and agents.
@@ -186,11 +391,14 @@ def landmark_connectivity(args) -> None:
     output_dir = args.output_dir
     assign_ownership = args.reindex
 
+    # Create the output directory once up front; every file below writes into it
+    os.makedirs(output_dir, exist_ok=True)
+
     for root, dirs, files in os.walk(dataset_dir):
         for file in files:
             if file.endswith(".pyfg"):
                 pyfg_filepath = os.path.join(root, file)
-                frequency = landmark_counter(pyfg_filepath, output_dir)
+                frequency = landmark_counter_to_csv(pyfg_filepath, output_dir)
 
                 if assign_ownership:
                     assign_ownership_to_landmarks(pyfg_filepath, frequency, output_dir)
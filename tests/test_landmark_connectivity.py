@@ -0,0 +1,258 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("numba")
+pytest.importorskip("py_factor_graph")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+
+import landmark_connectivity  # noqa: E402
+from py_factor_graph.io.pyfg_file import read_from_pyfg_file  # noqa: E402
+from py_factor_graph.utils.name_utils import get_robot_idx_from_char  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def per_measurement_counts(pyfg_filepath: str) -> np.ndarray:
+    """Count connectivity the way the script did before it parsed PyFG text itself."""
+    pyfg_data = read_from_pyfg_file(pyfg_filepath)
+    counts = np.zeros((pyfg_data.num_landmarks, pyfg_data.num_robots), dtype=np.int64)
+    for measure in pyfg_data.range_measurements:
+        robot, landmark = measure.association
+        if landmark[0] != "L":
+            continue
+        counts[int(landmark[1:]), get_robot_idx_from_char(robot[0])] += 1
+    return counts
+
+
+@pytest.fixture
+def gapped_robots_pyfg(tmp_path):
+    # Copy the dataset so the association sidecar is written to a temporary directory
+    pyfg_filepath = tmp_path / "gapped_robots.pyfg"
+    shutil.copy(os.path.join(DATA_DIR, "gapped_robots.pyfg"), pyfg_filepath)
+    return str(pyfg_filepath)
+
+
+def test_counts_match_per_measurement_parser(gapped_robots_pyfg):
+    expected = per_measurement_counts(gapped_robots_pyfg)
+    counts = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_counts_keep_robots_after_a_gap(gapped_robots_pyfg):
+    counts = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    np.testing.assert_array_equal(counts, [[2, 0, 1], [1, 0, 2], [0, 0, 0]])
+
+
+def test_counts_from_sidecar_match_parsed_counts(gapped_robots_pyfg):
+    parsed = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    assert os.path.exists(gapped_robots_pyfg + ".assoc.npz")
+    cached = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    np.testing.assert_array_equal(cached, parsed)
+
+
+def test_sidecar_is_rebuilt_when_dataset_is_replaced_with_old_mtime(gapped_robots_pyfg):
+    landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    pyfg_stat = os.stat(gapped_robots_pyfg)
+
+    # Replace the dataset but keep its old timestamps, as cp -p or rsync -t would
+    with open(gapped_robots_pyfg, "a") as f:
+        f.write("EDGE_RANGE 2.0 A1 L2 2.5 0.1\n")
+    os.utime(gapped_robots_pyfg, ns=(pyfg_stat.st_atime_ns, pyfg_stat.st_mtime_ns))
+
+    counts = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+    np.testing.assert_array_equal(counts, per_measurement_counts(gapped_robots_pyfg))
+    assert counts[2, 0] == 1
+
+
+def test_truncated_sidecar_is_treated_as_cache_miss(gapped_robots_pyfg):
+    expected = landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg)
+
+    # Simulate an interrupted write of the sidecar
+    sidecar_filepath = gapped_robots_pyfg + ".assoc.npz"
+    with open(sidecar_filepath, "rb") as f:
+        partial = f.read()[:32]
+    with open(sidecar_filepath, "wb") as f:
+        f.write(partial)
+
+    np.testing.assert_array_equal(landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg), expected)
+
+    # The sidecar is rewritten in full and nothing is left behind from the temporary file
+    np.testing.assert_array_equal(landmark_connectivity.landmark_counter_to_array(gapped_robots_pyfg), expected)
+    assert sorted(os.listdir(os.path.dirname(gapped_robots_pyfg))) == [
+        "gapped_robots.pyfg",
+        "gapped_robots.pyfg.assoc.npz",
+    ]
+
+
+@pytest.mark.parametrize(
+    "counts, expected",
+    [
+        (
+            np.array([[2, 0, 1], [0, 0, 0]]),
+            "landmark_symbol,A_count,B_count,C_count\nL0,2,0,1\nL1,0,0,0\n",
+        ),
+        (np.zeros((2, 0), dtype=np.int64), "landmark_symbol\nL0\nL1\n"),
+    ],
+)
+def test_append_frequency_to_csv(tmp_path, counts, expected):
+    csv_fp = tmp_path / "frequency.csv"
+    landmark_connectivity.append_frequency_to_csv(counts, str(csv_fp))
+    assert csv_fp.read_text() == expected
+
+
+def random_measurements(num_measurements, num_landmarks, num_robots):
+    rng = np.random.default_rng(0)
+    landmark_idx = rng.integers(0, num_landmarks, num_measurements).astype(np.int32)
+    robot_idx = rng.integers(0, num_robots, num_measurements).astype(np.int8)
+    return landmark_idx, robot_idx
+
+
+def test_parallel_histogram_matches_serial():
+    landmark_idx, robot_idx = random_measurements(100_000, 50, 4)
+    serial = landmark_connectivity._hist(landmark_idx, robot_idx, 50, 4)
+    parallel = landmark_connectivity._hist_par(
+        landmark_idx, robot_idx, 50, 4, landmark_connectivity.numba.get_num_threads()
+    )
+    np.testing.assert_array_equal(parallel, serial)
+    assert serial.sum() == landmark_idx.size
+
+
+def test_count_measurements_uses_parallel_kernel_only_with_small_bins(monkeypatch):
+    monkeypatch.setattr(landmark_connectivity, "PARALLEL_HIST_THRESHOLD", 0)
+    calls = []
+    hist_par = landmark_connectivity._hist_par
+    monkeypatch.setattr(
+        landmark_connectivity, "_hist_par", lambda *args: calls.append(args) or hist_par(*args)
+    )
+
+    landmark_idx, robot_idx = random_measurements(100_000, 50, 4)
+    counts = landmark_connectivity.count_measurements(landmark_idx, robot_idx, 50, 4)
+    np.testing.assert_array_equal(counts, landmark_connectivity._hist(landmark_idx, robot_idx, 50, 4))
+    assert len(calls) == 1
+
+    # Per-thread bins larger than the measurements fall back to the serial kernel
+    landmark_idx, robot_idx = random_measurements(100, 10_000, 4)
+    counts = landmark_connectivity.count_measurements(landmark_idx, robot_idx, 10_000, 4)
+    np.testing.assert_array_equal(counts, landmark_connectivity._hist(landmark_idx, robot_idx, 10_000, 4))
+    assert len(calls) == 1
+
+
+def write_pyfg(directory, name, lines):
+    pyfg_filepath = directory / name
+    pyfg_filepath.write_text("".join(lines))
+    return str(pyfg_filepath)
+
+
+def test_reindex_landmarks_only_rewrites_whole_symbols(tmp_path):
+    pyfg_filepath = write_pyfg(
+        tmp_path,
+        "prefixes.pyfg",
+        [
+            "VERTEX_XY L1 0.0 0.0\n",
+            "VERTEX_XY L10 0.0 0.0\n",
+            "VERTEX_XY L11 0.0 0.0\n",
+            "VERTEX_XY L12 0.0 0.0\n",
+            "EDGE_RANGE 0.0 A0 L1 1.0 0.1\n",
+            "EDGE_RANGE 0.0 B0 L10 1.0 0.1\n",
+            "EDGE_RANGE 0.0 A0 L12 1.0 0.1\n",
+            "EDGE_RANGE 0.0 B0 L11 1.0 0.1\n",
+        ],
+    )
+    landmark_owner = {"L1": "A", "L10": "B", "L12": "A"}
+    landmark_connectivity.reindex_landmarks(pyfg_filepath, 2, landmark_owner, str(tmp_path))
+
+    assert (tmp_path / "prefixes_with_ownership.pyfg").read_text() == "".join(
+        [
+            "VERTEX_XY LA0 0.0 0.0\n",
+            "VERTEX_XY LB0 0.0 0.0\n",
+            "VERTEX_XY L11 0.0 0.0\n",
+            "VERTEX_XY LA1 0.0 0.0\n",
+            "EDGE_RANGE 0.0 A0 LA0 1.0 0.1\n",
+            "EDGE_RANGE 0.0 B0 LB0 1.0 0.1\n",
+            "EDGE_RANGE 0.0 A0 LA1 1.0 0.1\n",
+            "EDGE_RANGE 0.0 B0 L11 1.0 0.1\n",
+        ]
+    )
+
+
+@pytest.mark.parametrize("final_newline", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 3, 5, 16])
+def test_reindex_landmarks_is_independent_of_chunk_size(tmp_path, monkeypatch, chunk_size, final_newline):
+    lines = [f"EDGE_RANGE {k}.0 A{k % 3} L{k % 12} 1.0 0.1\n" for k in range(40)]
+    if not final_newline:
+        lines[-1] = lines[-1].rstrip("\n")
+    pyfg_filepath = write_pyfg(tmp_path, "chunks.pyfg", lines)
+    landmark_owner = {f"L{i}": "AB"[i % 2] for i in range(0, 12, 3)}
+
+    default_dir = tmp_path / "default"
+    default_dir.mkdir()
+    landmark_connectivity.reindex_landmarks(pyfg_filepath, 2, landmark_owner, str(default_dir))
+
+    small_dir = tmp_path / "small"
+    small_dir.mkdir()
+    monkeypatch.setattr(landmark_connectivity, "REINDEX_CHUNK_SIZE", chunk_size)
+    # Also flush the output accumulator every few bytes
+    monkeypatch.setattr(landmark_connectivity, "IO_BUFFER_SIZE", 8)
+    landmark_connectivity.reindex_landmarks(pyfg_filepath, 2, landmark_owner, str(small_dir))
+
+    default_output = (default_dir / "chunks_with_ownership.pyfg").read_text()
+    assert (small_dir / "chunks_with_ownership.pyfg").read_text() == default_output
+    assert "LA0" in default_output and "LB0" in default_output
+    assert default_output.endswith("\n") == final_newline
+
+
+@pytest.fixture
+def captured_owners(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        landmark_connectivity,
+        "reindex_landmarks",
+        lambda pyfg_filepath, num_robots, landmark_owner, output_dir: calls.append((num_robots, landmark_owner)),
+    )
+    return calls
+
+
+def test_assign_ownership_rules(captured_owners):
+    counts = np.array(
+        [
+            [3, 1, 3],  # partial tie: first robot with the highest frequency wins
+            [2, 2, 2],  # full tie: random owner
+            [0, 0, 0],  # unseen: unowned
+            [0, 5, 1],
+        ]
+    )
+    np.random.seed(0)
+    tie_owner = "ABC"[np.random.randint(0, 3, 1)[0]]
+
+    np.random.seed(0)
+    landmark_connectivity.assign_ownership_to_landmarks("owners.pyfg", counts, "unused")
+
+    assert captured_owners == [(3, {"L0": "A", "L1": tie_owner, "L3": "B"})]
+
+
+def test_assign_ownership_without_robots(captured_owners):
+    counts = np.zeros((2, 0), dtype=np.int64)
+    landmark_connectivity.assign_ownership_to_landmarks("owners.pyfg", counts, "unused")
+    assert captured_owners == [(0, {})]
+
+
+@pytest.mark.parametrize(
+    "range_line",
+    [
+        "EDGE_RANGE 0.0 A0 L5 1.0 0.1\n",  # landmark that was never declared
+        "EDGE_RANGE 0.0 C0 L0 1.0 0.1\n",  # robot without pose vertices
+    ],
+)
+def test_undeclared_measurement_indices_raise(tmp_path, range_line):
+    pyfg_filepath = write_pyfg(
+        tmp_path,
+        "undeclared.pyfg",
+        ["VERTEX_SE2 0.0 A0 0.0 0.0 0.0\n", "VERTEX_XY L0 1.0 1.0\n", range_line],
+    )
+    with pytest.raises(ValueError):
+        landmark_connectivity.landmark_counter_to_array(pyfg_filepath)